@@ -2,59 +2,77 @@ import os
 import sys
 import time
 import argparse
-import time
+import tempfile
 
 import torch
 
 import rfantibody.proteinmpnn.util_protein_mpnn as mpnn_util
 from rfantibody.proteinmpnn.struct_manager import StructManager
 from rfantibody.proteinmpnn.sample_features import SampleFeatures
+from rfantibody.util.io import write_manifest
 
 
 #################################
 # Parse Arguments
 #################################
 
-parser = argparse.ArgumentParser()
-
-# I/O Arguments
-parser.add_argument("-pdbdir", type=str, default="", help='The name of a directory of pdbs to run through the model')
-parser.add_argument("-quiver", type=str, default="", help='The name of a quiver file to run this metric on.')
-
-parser.add_argument("-outquiver", type=str, default="out.qv",
-                    help="The name of the quiver file to which output structs will be written")
-parser.add_argument("-outpdbdir", type=str, default="outputs",
-                    help='The directory to which the output PDB files will be written')
-parser.add_argument("-runlist", type=str, default='',
-                    help="The path of a list of pdb tags to run (default: ''; Run all PDBs")
-parser.add_argument("-checkpoint_name", type=str, default='check.point',
-                    help="The name of a file where tags which have finished will be written (default: check.point)")
-parser.add_argument("-debug", action="store_true", default=False,
-                    help='When active, errors will cause the script to crash and the error message ' + \
-                         'to be printed out (default: False)')
-
-# Design Arguments
-parser.add_argument("-loop_string", type=str, default='H1,H2,H3,L1,L2,L3',
-                    help='The list of loops which you wish to design')
-parser.add_argument("-seqs_per_struct", type=int, default="1",
-                    help="The number of sequences to generate for each structure (default: 1)")
-
-# ProteinMPNN Specific Arguments
-default_ckpt = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'weights/ProteinMPNN_v48_noise_0.2.pt')
-parser.add_argument("-checkpoint_path", type=str, default=default_ckpt)
-parser.add_argument("-temperature", type=float, default=0.000001, help='An a3m file containing the MSA of your target')
-parser.add_argument("-augment_eps", type=float, default=0,
-                    help='The variance of random noise to add to the atomic coordinates (default 0)')
-parser.add_argument("-protein_features", type=str, default='full',
-                    help='What type of protein features to input to ProteinMPNN (default: full)')
-parser.add_argument("-omit_AAs", type=str, default='CX',
-                    help='A string of all residue types (one letter case-insensitive) that you would not like to ' + \
-                         'use for design. Letters not corresponding to residue types will be ignored')
-parser.add_argument("-num_connections", type=int, default=48,
-                    help='Number of neighbors each residue is connected to, default 48, higher number leads to ' + \
-                         'better interface design but will cost more to run the model.')
-
-args = parser.parse_args(sys.argv[1:])
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+
+    # I/O Arguments
+    parser.add_argument("-pdbdir", type=str, default="", help='The name of a directory of pdbs to run through the model')
+    parser.add_argument("-quiver", type=str, default="", help='The name of a quiver file to run this metric on.')
+
+    parser.add_argument("-outquiver", type=str, default="out.qv",
+                        help="The name of the quiver file to which output structs will be written")
+    parser.add_argument("-outpdbdir", type=str, default="outputs",
+                        help='The directory to which the output PDB files will be written')
+    parser.add_argument("-runlist", type=str, default='',
+                        help="The path of a list of pdb tags to run (default: ''; Run all PDBs")
+    parser.add_argument("-checkpoint_name", type=str, default='check.point',
+                        help="The name of a file where tags which have finished will be written (default: check.point)")
+    parser.add_argument("-debug", action="store_true", default=False,
+                        help='When active, errors will cause the script to crash and the error message ' + \
+                             'to be printed out (default: False)')
+
+    # Design Arguments
+    parser.add_argument("-loop_string", type=str, default='H1,H2,H3,L1,L2,L3',
+                        help='The list of loops which you wish to design')
+    parser.add_argument("-seqs_per_struct", type=int, default="1",
+                        help="The number of sequences to generate for each structure (default: 1)")
+    parser.add_argument("-batch_size", type=int, default=1,
+                        help="The number of structures to run through the model at once. Structures are " + \
+                             "grouped by length to limit padding (default: 1)")
+
+    # ProteinMPNN Specific Arguments
+    default_ckpt = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'weights/ProteinMPNN_v48_noise_0.2.pt')
+    parser.add_argument("-checkpoint_path", type=str, default=default_ckpt)
+    parser.add_argument("-temperature", type=float, default=0.000001, help='An a3m file containing the MSA of your target')
+    parser.add_argument("-augment_eps", type=float, default=0,
+                        help='The variance of random noise to add to the atomic coordinates (default 0)')
+    parser.add_argument("-protein_features", type=str, default='full',
+                        help='What type of protein features to input to ProteinMPNN (default: full)')
+    parser.add_argument("-omit_AAs", type=str, default='CX',
+                        help='A string of all residue types (one letter case-insensitive) that you would not like to ' + \
+                             'use for design. Letters not corresponding to residue types will be ignored')
+    parser.add_argument("-num_connections", type=int, default=48,
+                        help='Number of neighbors each residue is connected to, default 48, higher number leads to ' + \
+                             'better interface design but will cost more to run the model.')
+
+    return parser.parse_args(argv)
+
+def load_model(args: argparse.Namespace, device: str):
+    '''
+    Load the ProteinMPNN model weights onto the given device
+    '''
+    return mpnn_util.init_seq_optimize_model(
+        device,
+        hidden_dim=128,
+        num_layers = 3,
+        backbone_noise = args.augment_eps,
+        num_connections = args.num_connections,
+        checkpoint_path = args.checkpoint_path
+    )
 
 class ProteinMPNN_runner():
     '''
@@ -62,7 +80,7 @@ class ProteinMPNN_runner():
     the loading of the input data, the running of the model, and the processing of the output
     '''
 
-    def __init__(self, args, struct_manager):
+    def __init__(self, args, struct_manager, mpnn_model=None):
         self.struct_manager = struct_manager
 
         if torch.cuda.is_available():
@@ -72,60 +90,63 @@ class ProteinMPNN_runner():
             print('No GPU found, running ProteinMPNN on CPU')
             self.device = "cpu"
 
-        self.mpnn_model = mpnn_util.init_seq_optimize_model(
-            self.device,
-            hidden_dim=128,
-            num_layers = 3,
-            backbone_noise = args.augment_eps,
-            num_connections = args.num_connections,
-            checkpoint_path = args.checkpoint_path
-        )
+        # A preloaded model can be passed in to avoid reloading weights for every run
+        if mpnn_model is None:
+            mpnn_model = load_model(args, self.device)
+        self.mpnn_model = mpnn_model
 
         self.temperature = args.temperature
         self.seqs_per_struct = args.seqs_per_struct
         self.omit_AAs = [ letter for letter in args.omit_AAs.upper() if letter in list("ARNDCQEGHILKMFPSTWYVX") ]
 
-    def sequence_optimize(self, sample_feats: SampleFeatures) -> list[tuple[str, float]]:
+    def sequence_optimize(self, batch: list[SampleFeatures]) -> list[list[tuple[str, float]]]:
+        '''
+        Run MPNN on a batch of samples in a single padded forward pass.
+        Returns the (sequence, score) pairs for each sample in the batch
+        '''
         t0 = time.time()
 
+        feature_dicts = []
+        chain_id_dict = {}
+        fixed_positions_dict = {}
+
         # Once we have figured out pose I/O without Rosetta this will be easy to swap in
-        pdbfile = 'temp.pdb'
-        sample_feats.pose.dump_pdb(pdbfile)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for idx, sample_feats in enumerate(batch):
+                pdbfile = os.path.join(tmpdir, f'{idx}.pdb')
+                sample_feats.pose.dump_pdb(pdbfile)
 
-        feature_dict = mpnn_util.generate_seqopt_features(pdbfile, sample_feats.chains)
+                feature_dict = mpnn_util.generate_seqopt_features(pdbfile, sample_feats.chains)
+                feature_dicts.append(feature_dict)
 
-        os.remove(pdbfile)
+                masked_chains = sample_feats.chains[:-1]
+                visible_chains = [sample_feats.chains[-1]]
+
+                chain_id_dict[feature_dict['name']] = (masked_chains, visible_chains)
+                fixed_positions_dict[feature_dict['name']] = sample_feats.fixed_res
 
         arg_dict = mpnn_util.set_default_args(self.seqs_per_struct , omit_AAs=self.omit_AAs)
         arg_dict['temperature'] = self.temperature
 
-        masked_chains = sample_feats.chains[:-1]
-        visible_chains = [sample_feats.chains[-1]]
-
-        fixed_positions_dict = {pdbfile[:-len('.pdb')]: sample_feats.fixed_res}
-
-        sequences = mpnn_util.generate_sequences(
+        sequences = mpnn_util.generate_sequences_batch(
             self.mpnn_model,
             self.device,
-            feature_dict,
+            feature_dicts,
             arg_dict,
-            masked_chains,
-            visible_chains,
+            chain_id_dict,
             fixed_positions_dict=fixed_positions_dict
         )
         
-        print( f"MPNN generated {len(sequences)} sequences in {int( time.time() - t0 )} seconds" ) 
+        print( f"MPNN generated {sum(len(seqs) for seqs in sequences)} sequences for {len(batch)} structs in {int( time.time() - t0 )} seconds" ) 
 
         print(f'sequence_optimize: {sequences}')
 
         return sequences
 
-    def proteinmpnn(self, sample_feats: SampleFeatures) -> None:
+    def dump_designs(self, sample_feats: SampleFeatures, seqs_scores: list[tuple[str, float]]) -> None:
         '''
-        Run MPNN sequence optimization on the pose
+        Thread each designed sequence onto the pose and write it out
         '''
-        seqs_scores = self.sequence_optimize(sample_feats)
-
         # Iterate though each seq score pair and thread the sequence onto the pose
         # Then write each pose to a pdb file
         prefix = f"{sample_feats.tag}_dldesign"
@@ -136,9 +157,7 @@ class ProteinMPNN_runner():
 
             self.struct_manager.dump_pose(sample_feats.pose, outtag)
 
-    def run_model(self, tag, args):
-        t0 = time.time()
-
+    def load_sample(self, tag, args) -> SampleFeatures:
         print(f"Attempting pose: {tag}")
         
         # Load the pose 
@@ -150,38 +169,103 @@ class ProteinMPNN_runner():
         # Parse the loop string and determine which residues should be designed
         sample_feats.loop_string2fixed_res(args.loop_string)
 
-        self.proteinmpnn(sample_feats)
+        return sample_feats
+
+    def run_batch(self, batch: list[tuple[str, SampleFeatures]]) -> None:
+        t0 = time.time()
+
+        seqs_scores = self.sequence_optimize([sample_feats for _, sample_feats in batch])
+
+        for (_, sample_feats), sample_seqs_scores in zip(batch, seqs_scores):
+            self.dump_designs(sample_feats, sample_seqs_scores)
 
         seconds = int(time.time() - t0)
 
-        print(f"Struct: {pdb} reported success in {seconds} seconds")
+        for tag, _ in batch:
+            print(f"Struct: {tag} reported success in {seconds} seconds")
+
+
+def length_batches(samples: list[tuple[str, SampleFeatures]], batch_size: int) -> list:
+    '''
+    Group samples into batches of similar length to keep padding to a minimum
+    '''
+    samples = sorted(samples, key=lambda sample: sample[1].pose.chain.size)
+    return [samples[i:i + batch_size] for i in range(0, len(samples), batch_size)]
 
 
 ####################
 ####### Main #######
 ####################
 
-struct_manager = StructManager(args)
-proteinmpnn_runner = ProteinMPNN_runner(args, struct_manager)
+def run(args: argparse.Namespace, mpnn_model=None) -> list:
+    '''
+    Run ProteinMPNN over every input structure. Importable so that a long-lived
+    process can call it without re-launching this script, optionally reusing
+    an already loaded model. Returns the paths of the pdb files written.
+    '''
+    struct_manager = StructManager(args)
+    proteinmpnn_runner = ProteinMPNN_runner(args, struct_manager, mpnn_model=mpnn_model)
+
+    # Load every structure up front so that they can be batched by length
+    samples = []
+    for pdb in struct_manager.iterate():
 
-for pdb in struct_manager.iterate():
+        if args.debug: samples.append((pdb, proteinmpnn_runner.load_sample(pdb, args)))
 
-    if args.debug: proteinmpnn_runner.run_model(pdb, args)
+        else: # When not in debug mode the script will continue to run even when some poses fail
+            t0 = time.time()
 
-    else: # When not in debug mode the script will continue to run even when some poses fail
-        t0 = time.time()
+            try: samples.append((pdb, proteinmpnn_runner.load_sample(pdb, args)))
+
+            except KeyboardInterrupt: sys.exit("Script killed by Control+C, exiting")
+
+            except:
+                seconds = int(time.time() - t0)
+                print(f"Struct with tag {pdb} failed in {seconds} seconds with error: {sys.exc_info()[0]}")
+
+                # We are done with this pdb, record that we finished
+                struct_manager.record_checkpoint(pdb)
+
+    for batch in length_batches(samples, args.batch_size):
+
+        if args.debug: proteinmpnn_runner.run_batch(batch)
+
+        else:
+            t0 = time.time()
+            num_outputs = len(struct_manager.outputs)
+
+            try: proteinmpnn_runner.run_batch(batch)
+
+            except KeyboardInterrupt: sys.exit("Script killed by Control+C, exiting")
+
+            except:
+                print(f"Batch of {len(batch)} structs failed with error: {sys.exc_info()[0]}, retrying them one at a time")
+
+                # Forget any designs written before the failure, they are rewritten below
+                del struct_manager.outputs[num_outputs:]
+
+                # Retry each struct alone so one bad struct does not lose the whole batch
+                for sample in batch:
+                    t0 = time.time()
 
-        try: proteinmpnn_runner.run_model(pdb, args)
+                    try: proteinmpnn_runner.run_batch([sample])
 
-        except KeyboardInterrupt: sys.exit("Script killed by Control+C, exiting")
+                    except KeyboardInterrupt: sys.exit("Script killed by Control+C, exiting")
 
-        except:
-            seconds = int(time.time() - t0)
-            print(f"Struct with tag {pdb} failed in {seconds} seconds with error: {sys.exc_info()[0]}")
+                    except:
+                        seconds = int(time.time() - t0)
+                        print(f"Struct with tag {sample[0]} failed in {seconds} seconds with error: {sys.exc_info()[0]}")
 
-    # We are done with one pdb, record that we finished
-    struct_manager.record_checkpoint(pdb)
-    
+        # We are done with these pdbs, record that we finished
+        for pdb, _ in batch:
+            struct_manager.record_checkpoint(pdb)
 
+    return struct_manager.outputs
 
 
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    outputs = run(args)
+    if args.pdbdir != '':
+        os.makedirs(args.outpdbdir, exist_ok=True)
+        write_manifest(os.path.join(args.outpdbdir, 'manifest.json'), outputs)
@@ -7,25 +7,46 @@ import rfantibody.rf2.modules.util as util
 import rfantibody.rf2.modules.pose_util as pu
 from rfantibody.rf2.modules.model_runner import AbPredictor
 from rfantibody.rf2.modules.preprocess import pose_to_inference_RFinput, Preprocess
+from rfantibody.util.io import write_manifest
 import os
 
 _RF2_CONFIG_PATH = os.path.join(os.path.dirname(__file__), '../src/rfantibody/rf2/config')
 
-@hydra.main(version_base=None, config_path=_RF2_CONFIG_PATH, config_name='base')
-def main(conf: HydraConfig) -> None:
+def load_predictor(conf: HydraConfig) -> AbPredictor:
     """
-    Main function
+    Build a predictor, loading the model weights
     """
-    print(f'Running RF2 with the following configs: {conf}')
-    done_list=util.get_done_list(conf)
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     preprocessor=Preprocess(pose_to_inference_RFinput, conf)
-    predictor=AbPredictor(conf, preprocess_fn=preprocessor, device=device)
+    return AbPredictor(conf, preprocess_fn=preprocessor, device=device)
+
+def run(conf: HydraConfig, predictor: AbPredictor = None) -> list:
+    """
+    Run prediction from an already composed config, optionally reusing
+    an already loaded predictor. Returns the paths of the pdb files written
+    """
+    print(f'Running RF2 with the following configs: {conf}')
+    done_list=util.get_done_list(conf)
+    if predictor is None:
+        predictor=load_predictor(conf)
+    else:
+        predictor.update_conf(conf, Preprocess(pose_to_inference_RFinput, conf))
+    outputs=[]
     for pose, tag in pu.pose_generator(conf):
         if tag in done_list and conf.inference.cautious:
             print(f'Skipping {tag} as output already exists')
             continue
-        predictor(pose, tag)
+        outputs.extend(predictor(pose, tag))
+    return outputs
+
+@hydra.main(version_base=None, config_path=_RF2_CONFIG_PATH, config_name='base')
+def main(conf: HydraConfig) -> None:
+    """
+    Main function
+    """
+    outputs=run(conf)
+    if conf.output.pdb_dir is not None:
+        write_manifest(os.path.join(conf.output.pdb_dir, 'manifest.json'), outputs)
 
 if __name__ == '__main__':
     main()
@@ -15,6 +15,7 @@ See https://hydra.cc/docs/advanced/hydra-command-line-flags/ for more options.
 """
 
 import os
+import sys
 import time
 import pickle
 import re
@@ -30,7 +31,7 @@ import hydra
 import logging
 
 from rfantibody.rfdiffusion.util import writepdb_multi, writepdb, generate_Cbeta
-from rfantibody.util.io import ab_write_pdblines
+from rfantibody.util.io import ab_write_pdblines, write_manifest
 from rfantibody.rfdiffusion.chemical import num2aa
 from rfantibody.util.quiver import Quiver
 from rfantibody.rfdiffusion.inference import model_runners
@@ -42,14 +43,25 @@ def make_deterministic(seed=0):
         np.random.seed(seed)
         random.seed(seed)
 
-@hydra.main(version_base=None, config_path='config/inference', config_name='base')
-def main(conf: HydraConfig) -> None:
+def run(conf: HydraConfig, sampler: model_runners.AbSampler = None, initialize_sampler: bool = True) -> list:
+    """
+    Run design from an already composed config. Kept separate from main so
+    a long-lived process can call it without re-launching this script.
+
+    An existing sampler can be passed in to reuse its loaded model weights.
+    Pass initialize_sampler=False if it was just built from this config.
+    Returns the paths of the pdb files written.
+    """
     log = logging.getLogger(__name__)
     if conf.inference.deterministic:
         make_deterministic()
     
     # Initialize sampler and target/contig.
-    sampler = model_runners.AbSampler(conf)
+    if sampler is None:
+        sampler = model_runners.AbSampler(conf)
+    elif initialize_sampler:
+        # Only reloads weights if the checkpoint has changed
+        sampler.initialize(conf)
     
     # Loop over number of designs to sample.
     design_startnum = sampler.inf_conf.design_startnum
@@ -113,6 +125,8 @@ def main(conf: HydraConfig) -> None:
     #### Run the main design loop
     ############################################
 
+    outputs = []
+
     for i_des in range(design_startnum, design_startnum + sampler.inf_conf.num_designs):
         if conf.inference.deterministic:
             make_deterministic(i_des)
@@ -267,6 +281,7 @@ def main(conf: HydraConfig) -> None:
 
                 with open(out, 'w') as f_out:
                     f_out.write('\n'.join(pdblines))
+                outputs.append(out)
 
             else:
                 # Add to Quiver file
@@ -290,6 +305,7 @@ def main(conf: HydraConfig) -> None:
         else:
             # Now don't output sidechains
             writepdb(out, denoised_xyz_stack[0,:,:4], final_seq, sampler.binderlen, chain_idx=sampler.chain_idx, bfacts=bfacts)
+            outputs.append(out)
 
         #### Write Trajectory
         ####################################
@@ -321,5 +337,13 @@ def main(conf: HydraConfig) -> None:
 
         log.info(f'Finished design in {(time.time()-start_time)/60:.2f} minutes')
 
+    return outputs
+
+@hydra.main(version_base=None, config_path='config/inference', config_name='base')
+def main(conf: HydraConfig) -> None:
+    outputs = run(conf)
+    if conf.inference.quiver is None:
+        write_manifest(f'{conf.inference.output_prefix}.manifest.json', outputs)
+
 if __name__ == '__main__':
     main()
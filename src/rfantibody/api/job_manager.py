@@ -1,22 +1,32 @@
 """
 Job Manager for RFantibody API - handles async job execution
 """
-import uuid
+import os
+import secrets
 import asyncio
 import threading
 from datetime import datetime
-from typing import Dict, Optional
+from types import MappingProxyType
+from typing import Mapping, Optional
 from dataclasses import dataclass, field
 from enum import Enum
 import logging
 import traceback
+from collections import OrderedDict, deque
+from itertools import islice
 
 from .models import JobStatus
 
 logger = logging.getLogger(__name__)
 
+# How many queued jobs an executor looks through for ones that can share its RFdiffusion run
+RFDIFFUSION_BATCH_LOOKAHEAD = 8
 
-@dataclass
+# Marks a Job whose RFdiffusion batch key has not been computed yet
+_UNSET = object()
+
+
+@dataclass(slots=True)
 class Job:
     """Represents a running or completed job"""
     job_id: str
@@ -31,124 +41,385 @@ class Job:
     rfdiffusion_outputs: list = field(default_factory=list)
     proteinmpnn_outputs: list = field(default_factory=list)
     rf2_outputs: list = field(default_factory=list)
+    # Output files by basename, for downloads
+    outputs_by_name: dict = field(default_factory=dict)
+    # Status fields as served by the API, rebuilt whenever one of them changes
+    _status_cache: Optional[dict] = field(default=None, repr=False, compare=False)
+    # Bumped on every change, and the (loop, future) pairs of long-polls waiting for one
+    _version: int = field(default=0, repr=False, compare=False)
+    _waiters: list = field(default_factory=list, repr=False, compare=False)
+    # RFdiffusion batching: the job's input key, and designs made for it by a batched run
+    _batch_key: object = field(default=_UNSET, repr=False, compare=False)
+    _shared_designs: Optional[list] = field(default=None, repr=False, compare=False)
+    # Serialises changes to this job, so each status transition is applied as a whole
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self._status_cache = self._build_status()
+        
+    def _build_status(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "progress": self.progress,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "completed_at": self.completed_at,
+            "error": self.error
+        }
+        
+    def _mutate(self, **changes):
+        """Update job fields and refresh the cached status"""
+        with self._lock:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            # Swapped in whole, so readers never see a half-updated status
+            self._status_cache = self._build_status()
+            self._version += 1
+            waiters, self._waiters = self._waiters, []
+        
+        # Wake long-polls on their own event loops, we are on an executor thread
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                # The waiter's event loop has closed; nobody is left to wake, and
+                # this must never affect the job itself
+                pass
+        
+    def status_dict(self) -> dict:
+        """The job's status fields, without rebuilding them per request"""
+        return self._status_cache
+        
+    @property
+    def version(self) -> int:
+        """Counter bumped whenever the job's status changes"""
+        return self._version
+        
+    async def wait_for_change(self, version: int, timeout: float):
+        """Wait until the job's version moves past version, or timeout seconds pass"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            if self._version != version:
+                return
+            self._waiters.append(waiter)
+            
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
 
 
 class JobManager:
     """Manages job queue and execution"""
     
-    def __init__(self, max_concurrent_jobs: int = 1):
-        self.jobs: Dict[str, Job] = {}
+    def __init__(self, max_concurrent_jobs: Optional[int] = None, max_retained_jobs: int = 1000):
+        # Copy-on-write snapshot: replaced wholesale under the lock, never mutated,
+        # so readers can use it without locking
+        self._jobs_snapshot: Mapping[str, Job] = MappingProxyType({})
         self.max_concurrent_jobs = max_concurrent_jobs
+        # Finished jobs kept in memory, oldest first; older ones are forgotten
+        self.max_retained_jobs = max_retained_jobs
+        self._completed: OrderedDict = OrderedDict()
         self._lock = threading.Lock()
-        self._executor_thread: Optional[threading.Thread] = None
-        self._job_queue: list = []
+        self._cv = threading.Condition(self._lock)
+        self._executor_threads: list = []
+        self._model_workers: list = []
+        self._job_queue: deque = deque()
         self._running = False
         
     def start(self):
-        """Start the job executor thread"""
+        """
+        Start max_concurrent_jobs executor threads (one per GPU by default),
+        sharing the GPUs between them round-robin
+        """
+        import torch
+        from .model_worker import ModelWorker, STAGES
+        
+        num_gpus = torch.cuda.device_count()
+        if self.max_concurrent_jobs is None:
+            self.max_concurrent_jobs = max(1, num_gpus)
+        # Only use as many GPUs as there are executors to keep busy
+        num_devices = max(1, min(num_gpus, self.max_concurrent_jobs))
+            
+        # Keep each stage's models warm in its own process per GPU. Executors on the
+        # same GPU share these, so their jobs overlap on different stages
+        device_workers = []
+        for device_id in range(num_devices):
+            gpu_id = device_id if num_gpus else None
+            model_workers = {stage: ModelWorker(stage, gpu_id) for stage in STAGES}
+            for model_worker in model_workers.values():
+                model_worker.start()
+            self._model_workers.extend(model_workers.values())
+            device_workers.append((gpu_id, model_workers))
+            
         self._running = True
-        self._executor_thread = threading.Thread(target=self._job_executor, daemon=True)
-        self._executor_thread.start()
-        logger.info("Job executor started")
+        for worker_id in range(self.max_concurrent_jobs):
+            thread = threading.Thread(
+                target=self._job_executor,
+                args=device_workers[worker_id % num_devices],
+                name=f"job-executor-{worker_id}",
+                daemon=True
+            )
+            thread.start()
+            self._executor_threads.append(thread)
+        logger.info(
+            f"Job executor started with {self.max_concurrent_jobs} worker(s) on {num_devices} device(s)"
+        )
+        
+    @property
+    def jobs(self) -> Mapping[str, Job]:
+        """Read-only snapshot of all jobs"""
+        return self._jobs_snapshot
         
     def stop(self):
-        """Stop the job executor thread"""
-        self._running = False
-        if self._executor_thread:
-            self._executor_thread.join(timeout=5)
+        """Stop the job executor threads"""
+        with self._cv:
+            self._running = False
+            self._cv.notify_all()
+        for thread in self._executor_threads:
+            thread.join(timeout=5)
+        self._executor_threads = []
+        for model_worker in self._model_workers:
+            model_worker.stop()
+        self._model_workers = []
         logger.info("Job executor stopped")
         
     def create_job(self, config: dict) -> Job:
         """Create a new job and add to queue"""
-        job_id = str(uuid.uuid4())[:8]
-        job = Job(
-            job_id=job_id,
-            status=JobStatus.PENDING,
-            created_at=datetime.utcnow(),
-            config=config
-        )
+        # Build the job before taking the lock, which only guards the insert
+        created_at = datetime.utcnow()
         
-        with self._lock:
-            self.jobs[job_id] = job
-            self._job_queue.append(job_id)
+        while True:
+            job_id = secrets.token_hex(4)
+            job = Job(
+                job_id=job_id,
+                status=JobStatus.PENDING,
+                created_at=created_at,
+                config=config
+            )
+            
+            with self._lock:
+                # Short IDs can collide, so retry rather than replace an existing job
+                if job_id in self._jobs_snapshot:
+                    continue
+                jobs = dict(self._jobs_snapshot)
+                jobs[job_id] = job
+                self._jobs_snapshot = MappingProxyType(jobs)
+                self._job_queue.append(job_id)
+                self._cv.notify()
+                break
             
         logger.info(f"Created job {job_id}")
         return job
     
     def get_job(self, job_id: str) -> Optional[Job]:
         """Get job by ID"""
-        return self.jobs.get(job_id)
+        return self._jobs_snapshot.get(job_id)
     
     def get_all_jobs(self) -> list:
         """Get all jobs"""
-        return list(self.jobs.values())
+        return list(self._jobs_snapshot.values())
     
-    def _job_executor(self):
-        """Background thread that executes jobs from queue"""
+    def _job_executor(self, gpu_id: Optional[int] = None, model_workers: Optional[dict] = None):
+        """Background thread that executes jobs from queue, pinned to one GPU"""
         from .pipeline import run_antibody_pipeline
         
-        while self._running:
-            job_id = None
-            
-            with self._lock:
-                # Count running jobs
-                running_count = sum(
-                    1 for j in self.jobs.values() 
-                    if j.status == JobStatus.RUNNING
-                )
-                
-                # Get next pending job if we have capacity
-                if running_count < self.max_concurrent_jobs and self._job_queue:
-                    job_id = self._job_queue.pop(0)
+        while True:
+            with self._cv:
+                # Block until a job is queued or we are stopped. The number of
+                # executor threads caps how many jobs run at once
+                while self._running and not self._job_queue:
+                    self._cv.wait()
+                    
+                if not self._running:
+                    return
                     
-            if job_id:
-                job = self.jobs.get(job_id)
-                if job and job.status == JobStatus.PENDING:
-                    self._execute_job(job, run_antibody_pipeline)
-            else:
-                # No jobs to process, sleep a bit
-                import time
-                time.sleep(1)
+                job_id = self._job_queue.popleft()
+                # Queued jobs that may be able to share this job's RFdiffusion run
+                candidates = list(islice(self._job_queue, RFDIFFUSION_BATCH_LOOKAHEAD))
+                
+            job = self._jobs_snapshot.get(job_id)
+            if job and job.status == JobStatus.PENDING:
+                batch = self._claim_rfdiffusion_batch(job, candidates)
+                self._execute_job(job, run_antibody_pipeline, gpu_id, model_workers, batch)
+                
+    def _rfdiffusion_batch_key(self, job: Job) -> Optional[tuple]:
+        """Key of a job's RFdiffusion inputs, or None if it cannot be batched"""
+        from .pipeline import rfdiffusion_batch_key
+        
+        if job._batch_key is _UNSET:
+            try:
+                job._batch_key = rfdiffusion_batch_key(job.config)
+            except (OSError, KeyError, TypeError) as e:
+                logger.warning(f"Job {job.job_id} cannot be batched: {e}")
+                job._batch_key = None
+        return job._batch_key
+        
+    def _claim_rfdiffusion_batch(self, job: Job, candidates: list) -> list:
+        """Take queued jobs with the same RFdiffusion inputs as job off the queue"""
+        if job._shared_designs is not None:
+            return []
+        key = self._rfdiffusion_batch_key(job)
+        if key is None:
+            return []
+            
+        matches = []
+        for candidate_id in candidates:
+            candidate = self._jobs_snapshot.get(candidate_id)
+            if (
+                candidate is not None
+                and candidate.status == JobStatus.PENDING
+                and candidate._shared_designs is None
+                and self._rfdiffusion_batch_key(candidate) == key
+            ):
+                matches.append(candidate)
+        if not matches:
+            return []
+            
+        batch = []
+        with self._lock:
+            for candidate in matches:
+                # Another executor may have taken it while we were hashing inputs
+                try:
+                    self._job_queue.remove(candidate.job_id)
+                except ValueError:
+                    continue
+                batch.append(candidate)
+        return batch
+        
+    def _run_rfdiffusion_batch(
+        self,
+        job: Job,
+        batch: list,
+        gpu_id: Optional[int] = None,
+        model_workers: Optional[dict] = None
+    ):
+        """Run RFdiffusion once for job and the jobs batched with it, then requeue those"""
+        from .pipeline import run_batched_rfdiffusion
+        
+        jobs = [job, *batch]
+        logger.info(f"Batching RFdiffusion for jobs {[j.job_id for j in jobs]}")
+        for batch_job in batch:
+            self._update_progress(batch_job.job_id, f"Running RFdiffusion batched with job {job.job_id}...")
+            
+        try:
+            designs = run_batched_rfdiffusion(
+                [(j.job_id, j.config) for j in jobs],
+                progress_callback=lambda msg: self._update_progress(job.job_id, msg),
+                gpu_id=gpu_id,
+                worker=(model_workers or {}).get("rfdiffusion")
+            )
+            for batch_job in jobs:
+                batch_job._shared_designs = designs[batch_job.job_id]
+        except Exception as e:
+            # Each job will run RFdiffusion on its own instead; stop them being
+            # batched together again, which would repeat the failing run
+            logger.error(f"Batched RFdiffusion for job {job.job_id} failed: {e}\n{traceback.format_exc()}")
+            for batch_job in batch:
+                batch_job._batch_key = None
+            
+        # Put the batched jobs back at the front of the queue to run the rest of their pipelines
+        with self._cv:
+            self._job_queue.extendleft(batch_job.job_id for batch_job in reversed(batch))
+            self._cv.notify_all()
                 
-    def _execute_job(self, job: Job, pipeline_fn):
-        """Execute a single job"""
-        logger.info(f"Starting job {job.job_id}")
+    def _execute_job(
+        self,
+        job: Job,
+        pipeline_fn,
+        gpu_id: Optional[int] = None,
+        model_workers: Optional[dict] = None,
+        batch: Optional[list] = None
+    ):
+        """Execute a single job, first running RFdiffusion for any jobs batched with it"""
+        logger.info(f"Starting job {job.job_id} (gpu={gpu_id})")
         
-        job.status = JobStatus.RUNNING
-        job.started_at = datetime.utcnow()
-        job.progress = "Starting pipeline..."
+        job._mutate(
+            status=JobStatus.RUNNING,
+            started_at=datetime.utcnow(),
+            progress="Starting pipeline..."
+        )
+        
+        if batch:
+            self._run_rfdiffusion_batch(job, batch, gpu_id, model_workers)
         
         try:
             # Run the pipeline
             result = pipeline_fn(
                 job_id=job.job_id,
                 config=job.config,
-                progress_callback=lambda msg: self._update_progress(job.job_id, msg)
+                progress_callback=lambda msg: self._update_progress(job.job_id, msg),
+                gpu_id=gpu_id,
+                workers=model_workers,
+                rfdiffusion_outputs=job._shared_designs
             )
             
-            job.status = JobStatus.COMPLETED
-            job.completed_at = datetime.utcnow()
-            job.output_dir = result.get("output_dir")
-            job.rfdiffusion_outputs = result.get("rfdiffusion_outputs", [])
-            job.proteinmpnn_outputs = result.get("proteinmpnn_outputs", [])
-            job.rf2_outputs = result.get("rf2_outputs", [])
-            job.progress = "Completed successfully"
+            rfdiffusion_outputs = result.get("rfdiffusion_outputs", [])
+            proteinmpnn_outputs = result.get("proteinmpnn_outputs", [])
+            rf2_outputs = result.get("rf2_outputs", [])
+            all_outputs = rfdiffusion_outputs + proteinmpnn_outputs + rf2_outputs
+            
+            job._mutate(
+                output_dir=result.get("output_dir"),
+                rfdiffusion_outputs=rfdiffusion_outputs,
+                proteinmpnn_outputs=proteinmpnn_outputs,
+                rf2_outputs=rf2_outputs,
+                # Reversed so that, as before, the earliest stage wins on a name clash
+                outputs_by_name={os.path.basename(path): path for path in reversed(all_outputs)},
+                status=JobStatus.COMPLETED,
+                completed_at=datetime.utcnow(),
+                progress="Completed successfully"
+            )
             
             logger.info(f"Job {job.job_id} completed successfully")
             
         except Exception as e:
-            job.status = JobStatus.FAILED
-            job.completed_at = datetime.utcnow()
-            job.error = str(e)
-            job.progress = f"Failed: {str(e)}"
+            job._mutate(
+                status=JobStatus.FAILED,
+                completed_at=datetime.utcnow(),
+                error=str(e),
+                progress=f"Failed: {str(e)}"
+            )
             logger.error(f"Job {job.job_id} failed: {e}\n{traceback.format_exc()}")
             
+        self._retire(job)
+        
+    def _retire(self, job: Job):
+        """Record a finished job, evicting the oldest finished jobs over max_retained_jobs"""
+        with self._lock:
+            self._completed[job.job_id] = None
+            if len(self._completed) <= self.max_retained_jobs:
+                return
+                
+            jobs = dict(self._jobs_snapshot)
+            while len(self._completed) > self.max_retained_jobs:
+                old_job_id, _ = self._completed.popitem(last=False)
+                jobs.pop(old_job_id, None)
+            self._jobs_snapshot = MappingProxyType(jobs)
+            
     def _update_progress(self, job_id: str, message: str):
         """Update job progress"""
-        job = self.jobs.get(job_id)
-        if job:
-            job.progress = message
-            logger.info(f"Job {job_id}: {message}")
+        job = self._jobs_snapshot.get(job_id)
+        # A repeated message changes nothing, so don't wake long-polls or log it again
+        if not job or job.progress == message:
+            return
+            
+        job._mutate(progress=message)
+        logger.info(f"Job {job_id}: {message}")
 
 
 # Global job manager instance
@@ -2,13 +2,16 @@
 RFantibody API - FastAPI application for antibody design
 """
 import os
+import re
 import logging
 from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import List, Optional
 
+import anyio
+import anyio.to_thread
 import torch
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Header, Query, Response
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -21,6 +24,7 @@ from .models import (
     JobStatus
 )
 from .job_manager import job_manager, Job
+from .pipeline import save_pdb_upload
 
 # Configure logging
 logging.basicConfig(
@@ -29,6 +33,57 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Longest a status request may be held open waiting for the job to change
+MAX_STATUS_WAIT = 60
+
+# Largest PDB file accepted by the upload endpoint
+MAX_PDB_BYTES = 32 * 1024 * 1024
+
+# Caps how many uploads are written to disk at once, so concurrent uploads
+# cannot take over the threadpool
+_upload_limiter = anyio.CapacityLimiter(4)
+
+# Hotspots are a chain and residue number, e.g. T305. Loops are an upper-case CDR
+# name and optional lengths: a length or range, '|'-separated alternatives (H3:5-7|9),
+# or none (H1:) to design the loop at its framework length. RFdiffusion only builds
+# the design mask for upper-case loop names
+_HOTSPOT_RE = re.compile(r'[A-Z]\d+')
+_DESIGN_LOOP_RE = re.compile(r'[LH][123]:(\d+(-\d+)?(\|\d+(-\d+)?)*)?')
+
+
+def _check_upload_size(upload: UploadFile):
+    """Reject an upload whose recorded size is over MAX_PDB_BYTES"""
+    if upload.size is not None and upload.size > MAX_PDB_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{upload.filename} is larger than the {MAX_PDB_BYTES // (1024 * 1024)} MB limit"
+        )
+
+
+async def _save_upload(upload: UploadFile) -> str:
+    """Stream an uploaded PDB to disk off the event loop, return path"""
+    try:
+        # The size is enforced again while streaming, in case none was recorded
+        return await anyio.to_thread.run_sync(
+            save_pdb_upload, upload.file, MAX_PDB_BYTES, limiter=_upload_limiter
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{upload.filename} is larger than the {MAX_PDB_BYTES // (1024 * 1024)} MB limit"
+        )
+
+
+def _validate_design_inputs(hotspots: list, loops: Optional[list]):
+    """Reject malformed hotspots and loops before they reach RFdiffusion"""
+    bad = [h for h in hotspots if not _HOTSPOT_RE.fullmatch(h)]
+    if bad:
+        raise HTTPException(status_code=422, detail=f"Invalid hotspot format: {bad}")
+    
+    bad = [l for l in loops or [] if not _DESIGN_LOOP_RE.fullmatch(l)]
+    if bad:
+        raise HTTPException(status_code=422, detail=f"Invalid design loop format: {bad}")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -94,6 +149,8 @@ async def create_design_job(request: AntibodyDesignRequest):
     - run_full_pipeline: Run all 3 steps or just RFdiffusion
     """
     
+    _validate_design_inputs(request.hotspot_residues, request.design_loops)
+    
     # Build config from request
     config = {
         "target_pdb": request.target_pdb,
@@ -132,26 +189,34 @@ async def create_design_job_with_upload(
     Use this endpoint to upload PDB files directly.
     """
     
-    # Read target PDB
-    target_content = (await target_pdb.read()).decode('utf-8')
-    
-    # Read framework PDB if provided
-    framework_content = None
-    if framework_pdb:
-        framework_content = (await framework_pdb.read()).decode('utf-8')
-    
     # Parse hotspot residues
-    hotspots = [r.strip() for r in hotspot_residues.split(',')]
+    hotspots = [r.strip() for r in hotspot_residues.split(',') if r.strip()]
     
     # Parse design loops if provided
     loops = None
     if design_loops:
-        loops = [l.strip() for l in design_loops.split(',')]
+        loops = [l.strip() for l in design_loops.split(',') if l.strip()]
+    
+    # Validate before spending time on the uploads
+    _validate_design_inputs(hotspots, loops)
+    
+    # Check every upload before saving any, so a rejected one leaves nothing behind
+    _check_upload_size(target_pdb)
+    if framework_pdb:
+        _check_upload_size(framework_pdb)
+    
+    # Stream target PDB to disk rather than holding it in memory
+    target_path = await _save_upload(target_pdb)
+    
+    # Stream framework PDB to disk if provided
+    framework_path = None
+    if framework_pdb:
+        framework_path = await _save_upload(framework_pdb)
     
     # Build config
     config = {
-        "target_pdb": target_content,
-        "framework_pdb": framework_content,
+        "target_pdb": target_path,
+        "framework_pdb": framework_path,
         "hotspot_residues": hotspots,
         "design_loops": loops,
         "num_designs": num_designs,
@@ -171,22 +236,45 @@ async def create_design_job_with_upload(
 
 
 @app.get("/jobs/{job_id}", response_model=JobStatusResponse)
-async def get_job_status(job_id: str):
-    """Get the status of a job"""
+async def get_job_status(
+    job_id: str,
+    response: Response,
+    wait: float = Query(0, ge=0, le=MAX_STATUS_WAIT, description="Seconds to wait for the status to change"),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Get the status of a job.
+    
+    Responses carry an ETag. Send it back as If-None-Match to get an empty 304
+    if nothing has changed, and add ?wait=<seconds> to hold the request open
+    until the job changes instead of polling.
+    """
     
     job = job_manager.get_job(job_id)
     if not job:
         raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
     
-    return JobStatusResponse(
-        job_id=job.job_id,
-        status=job.status,
-        progress=job.progress,
-        created_at=job.created_at,
-        started_at=job.started_at,
-        completed_at=job.completed_at,
-        error=job.error
-    )
+    # Only hold the request if the client already has the current state and the
+    # job can still change; otherwise there is something (or nothing) to send now
+    version = job.version
+    if (
+        wait > 0
+        and if_none_match == _job_etag(job_id, version)
+        and job.status not in (JobStatus.COMPLETED, JobStatus.FAILED)
+    ):
+        await job.wait_for_change(version, timeout=wait)
+        version = job.version
+    
+    etag = _job_etag(job_id, version)
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    response.headers["ETag"] = etag
+    return JobStatusResponse.model_construct(**job.status_dict())
+
+
+def _job_etag(job_id: str, version: int) -> str:
+    return f'W/"{job_id}-{version}"'
 
 
 @app.get("/jobs/{job_id}/results", response_model=JobResultResponse)
@@ -226,14 +314,19 @@ async def download_output_file(job_id: str, filename: str):
         raise HTTPException(status_code=400, detail="Job is not completed")
     
     # Find file in outputs
-    all_files = job.rfdiffusion_outputs + job.proteinmpnn_outputs + job.rf2_outputs
-    matching = [f for f in all_files if os.path.basename(f) == filename]
+    path = job.outputs_by_name.get(filename)
+    if not path:
+        raise HTTPException(status_code=404, detail=f"File {filename} not found")
     
-    if not matching:
+    # Stat once here and hand it over, rather than FileResponse stat'ing again
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail=f"File {filename} not found")
     
     return FileResponse(
-        matching[0],
+        path,
+        stat_result=stat_result,
         media_type="chemical/x-pdb",
         filename=filename
     )
@@ -243,19 +336,9 @@ async def download_output_file(job_id: str, filename: str):
 async def list_jobs():
     """List all jobs"""
     
+    # Jobs keep their status pre-built, so skip re-validating every one of them
     jobs = job_manager.get_all_jobs()
-    return [
-        JobStatusResponse(
-            job_id=job.job_id,
-            status=job.status,
-            progress=job.progress,
-            created_at=job.created_at,
-            started_at=job.started_at,
-            completed_at=job.completed_at,
-            error=job.error
-        )
-        for job in jobs
-    ]
+    return [JobStatusResponse.model_construct(**job.status_dict()) for job in jobs]
 
 
 # Run with: uvicorn rfantibody.api.main:app --host 0.0.0.0 --port 8000
@@ -0,0 +1,209 @@
+"""
+Model workers for RFantibody API - long-lived processes that run pipeline stages
+"""
+import os
+import sys
+import queue
+import threading
+import traceback
+import multiprocessing as mp
+from typing import Optional
+import logging
+
+from .pipeline import RFANTIBODY_ROOT, subprocess_env
+
+logger = logging.getLogger(__name__)
+
+# Pipeline stages that can be served by a worker
+STAGES = ("rfdiffusion", "proteinmpnn", "rf2")
+
+RFDIFFUSION_CONFIG_DIR = os.path.join(RFANTIBODY_ROOT, "scripts", "config", "inference")
+RF2_CONFIG_DIR = os.path.join(RFANTIBODY_ROOT, "src", "rfantibody", "rf2", "config")
+
+# How often a waiting caller checks that the worker process is still alive
+_POLL_INTERVAL = 1.0
+
+
+def _compose_hydra_config(config_dir: str, default_config_name: str, args: list):
+    """Compose a hydra config from script-style command line arguments"""
+    from hydra import compose, initialize_config_dir
+
+    config_name = default_config_name
+    overrides = list(args)
+    if "--config-name" in overrides:
+        i = overrides.index("--config-name")
+        config_name = overrides[i + 1]
+        del overrides[i:i + 2]
+
+    with initialize_config_dir(config_dir=config_dir, version_base=None):
+        return compose(config_name=config_name, overrides=overrides)
+
+
+class RFdiffusionWorker:
+    """Runs RFdiffusion, keeping the sampler and its model weights loaded between runs"""
+
+    def __init__(self):
+        self.sampler = None
+        self._model_T = None
+
+    def __call__(self, args: list):
+        from scripts import rfdiffusion_inference
+
+        conf = _compose_hydra_config(RFDIFFUSION_CONFIG_DIR, "base", args)
+
+        # The model is built for a fixed number of timesteps, so rebuild it
+        # if a job asks for a different diffusion_steps
+        if self.sampler is not None and self._model_T != conf.diffuser.T:
+            self.sampler = None
+            self._model_T = None
+
+        if self.sampler is None:
+            # Built from this job's config, as the script does, so run() does
+            # not need to initialize it a second time
+            self.sampler = rfdiffusion_inference.model_runners.AbSampler(conf)
+            self._model_T = conf.diffuser.T
+            return rfdiffusion_inference.run(conf, sampler=self.sampler, initialize_sampler=False)
+
+        return rfdiffusion_inference.run(conf, sampler=self.sampler)
+
+
+class ProteinMPNNWorker:
+    """Runs ProteinMPNN, keeping the model weights loaded between runs"""
+
+    def __init__(self):
+        self.mpnn_model = None
+        self._model_key = None
+
+    def __call__(self, args: list):
+        import torch
+        from scripts import proteinmpnn_interface_design
+
+        args = proteinmpnn_interface_design.parse_args(args)
+
+        model_key = (args.checkpoint_path, args.augment_eps, args.num_connections)
+        if self._model_key != model_key:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+            self.mpnn_model = proteinmpnn_interface_design.load_model(args, device)
+            self._model_key = model_key
+
+        return proteinmpnn_interface_design.run(args, mpnn_model=self.mpnn_model)
+
+
+class RF2Worker:
+    """Runs RF2, keeping the predictor and its model weights loaded between runs"""
+
+    def __init__(self):
+        self.predictor = None
+
+    def __call__(self, args: list):
+        from scripts import rf2_predict
+
+        conf = _compose_hydra_config(RF2_CONFIG_DIR, "base", args)
+
+        if self.predictor is None or self.predictor.conf.model.model_weights != conf.model.model_weights:
+            self.predictor = rf2_predict.load_predictor(conf)
+
+        return rf2_predict.run(conf, predictor=self.predictor)
+
+
+_STAGE_RUNNERS = {
+    "rfdiffusion": RFdiffusionWorker,
+    "proteinmpnn": ProteinMPNNWorker,
+    "rf2": RF2Worker,
+}
+
+
+def _worker_main(stage: str, gpu_id: Optional[int], requests, responses):
+    """Entry point of the worker process: serve requests until told to stop"""
+    # Must happen before anything initialises CUDA in this process
+    env = subprocess_env(gpu_id)
+    os.environ.update(env)
+    for path in reversed([RFANTIBODY_ROOT] + env["PYTHONPATH"].split(":")):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    # Lives for the whole process, so loaded models are reused across jobs
+    runner = _STAGE_RUNNERS[stage]()
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        args, cwd = request
+        try:
+            os.chdir(cwd)
+            responses.put((True, runner(args)))
+        except BaseException:
+            # Scripts signal some failures with sys.exit, so catch those too
+            responses.put((False, traceback.format_exc()))
+
+
+class ModelWorker:
+    """
+    A daemon process that runs one pipeline stage in-process, so Python start-up,
+    torch import and CUDA initialisation are paid once rather than per job
+    """
+
+    def __init__(self, stage: str, gpu_id: Optional[int] = None):
+        if stage not in _STAGE_RUNNERS:
+            raise ValueError(f"Unknown pipeline stage: {stage}")
+        self.stage = stage
+        self.gpu_id = gpu_id
+        # CUDA cannot be used from forked processes
+        self._ctx = mp.get_context("spawn")
+        self._lock = threading.Lock()
+        self._process = None
+        self._requests = None
+        self._responses = None
+
+    def start(self):
+        """Start the worker process"""
+        self._requests = self._ctx.Queue()
+        self._responses = self._ctx.Queue()
+        self._process = self._ctx.Process(
+            target=_worker_main,
+            args=(self.stage, self.gpu_id, self._requests, self._responses),
+            name=f"{self.stage}-worker-{self.gpu_id}",
+            daemon=True
+        )
+        self._process.start()
+        logger.info(f"Started {self.stage} worker (gpu={self.gpu_id}, pid={self._process.pid})")
+
+    def stop(self, timeout: float = 5):
+        """Stop the worker process"""
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self._requests.put(None)
+            self._process.join(timeout=timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._process = None
+        logger.info(f"Stopped {self.stage} worker (gpu={self.gpu_id})")
+
+    def run(self, args: list, cwd: str):
+        """
+        Run the stage with script-style command line arguments and return its result
+
+        Raises:
+            RuntimeError: if the stage raised, or the worker process died
+        """
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self.start()
+
+            self._requests.put((args, cwd))
+            while True:
+                try:
+                    ok, result = self._responses.get(timeout=_POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    if not self._process.is_alive():
+                        exitcode = self._process.exitcode
+                        self._process = None
+                        raise RuntimeError(f"{self.stage} worker exited with code {exitcode}")
+
+        if not ok:
+            raise RuntimeError(result)
+        return result
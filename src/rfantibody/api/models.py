@@ -1,7 +1,7 @@
 """
 Pydantic models for RFantibody API
 """
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List
 from enum import Enum
 from datetime import datetime
@@ -16,6 +16,7 @@ class JobStatus(str, Enum):
 
 class AntibodyDesignRequest(BaseModel):
     """Request model for antibody design job"""
+    model_config = ConfigDict(extra="ignore")
     
     # Target protein PDB (required) - can be file content or path
     target_pdb: str = Field(..., description="Target protein PDB file content or path")
@@ -63,6 +64,8 @@ class AntibodyDesignRequest(BaseModel):
 
 class JobResponse(BaseModel):
     """Response model for job creation"""
+    model_config = ConfigDict(extra="ignore")
+
     job_id: str
     status: JobStatus
     message: str
@@ -71,6 +74,8 @@ class JobResponse(BaseModel):
 
 class JobStatusResponse(BaseModel):
     """Response model for job status query"""
+    model_config = ConfigDict(extra="ignore")
+
     job_id: str
     status: JobStatus
     progress: Optional[str] = None
@@ -82,6 +87,8 @@ class JobStatusResponse(BaseModel):
 
 class JobResultResponse(BaseModel):
     """Response model for job results"""
+    model_config = ConfigDict(extra="ignore")
+
     job_id: str
     status: JobStatus
     output_files: Optional[List[str]] = None
@@ -93,6 +100,8 @@ class JobResultResponse(BaseModel):
 
 class HealthResponse(BaseModel):
     """Health check response"""
+    model_config = ConfigDict(extra="ignore")
+
     status: str
     version: str
     gpu_available: bool
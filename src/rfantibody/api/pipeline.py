@@ -3,11 +3,13 @@ Pipeline execution for RFantibody API
 Runs RFdiffusion -> ProteinMPNN -> RF2 in sequence
 """
 import os
-import glob
+import json
+import hashlib
 import shutil
 import subprocess
 import tempfile
-from typing import Callable, Optional
+from collections import deque
+from typing import BinaryIO, Callable, Optional
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,6 +19,18 @@ RFANTIBODY_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirnam
 WEIGHTS_DIR = os.path.join(RFANTIBODY_ROOT, "weights")
 EXAMPLES_DIR = os.path.join(RFANTIBODY_ROOT, "scripts", "examples", "example_inputs")
 JOBS_OUTPUT_DIR = os.path.join(RFANTIBODY_ROOT, "jobs_output")
+# Content-addressed store of input PDBs, named by SHA256 and hardlinked into job dirs
+PDB_CACHE_DIR = os.path.join(JOBS_OUTPUT_DIR, "pdb_cache")
+BATCHES_DIR = os.path.join(JOBS_OUTPUT_DIR, "batches")
+
+# Chunk size used when streaming uploaded files to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Number of trailing stderr lines kept from failed model subprocesses
+STDERR_TAIL_LINES = 200
+
+# Number of structures ProteinMPNN designs in a single forward pass
+MPNN_BATCH_SIZE = 8
 
 # Default files
 DEFAULT_FRAMEWORK_PDB = os.path.join(EXAMPLES_DIR, "hu-4D5-8_Fv.pdb")
@@ -33,16 +47,167 @@ def ensure_output_dir(job_id: str) -> str:
     return output_dir
 
 
+def subprocess_env(gpu_id: Optional[int] = None) -> dict:
+    """Build the environment for model subprocesses, optionally pinned to one GPU"""
+    env = {
+        **os.environ,
+        "PYTHONPATH": f"{os.path.join(RFANTIBODY_ROOT, 'src')}:{os.path.join(RFANTIBODY_ROOT, 'include', 'SE3Transformer')}"
+    }
+    
+    if gpu_id is not None:
+        # gpu_id indexes the devices visible to this process, which may
+        # already be restricted by CUDA_VISIBLE_DEVICES
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+        devices = visible.split(",") if visible else None
+        env["CUDA_VISIBLE_DEVICES"] = devices[gpu_id].strip() if devices else str(gpu_id)
+    
+    return env
+
+
+def _cache_pdb(tmp_path: str, digest: str) -> str:
+    """Move a fully written temp file into the PDB cache under its digest, return path"""
+    cache_path = os.path.join(PDB_CACHE_DIR, f"{digest}.pdb")
+    if os.path.exists(cache_path):
+        os.remove(tmp_path)
+    else:
+        # Atomic, so the cache never holds a partial file
+        os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def save_pdb_upload(fileobj: BinaryIO, max_bytes: Optional[int] = None) -> str:
+    """
+    Stream an uploaded PDB file into the PDB cache in chunks, return path
+    
+    Raises:
+        ValueError: if the file is larger than max_bytes
+    """
+    os.makedirs(PDB_CACHE_DIR, exist_ok=True)
+    h = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=PDB_CACHE_DIR, suffix=".tmp", delete=False) as f:
+        for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK_SIZE), b""):
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                break
+            h.update(chunk)
+            f.write(chunk)
+    
+    if max_bytes is not None and size > max_bytes:
+        os.remove(f.name)
+        raise ValueError(f"PDB file is larger than {max_bytes} bytes")
+    return _cache_pdb(f.name, h.hexdigest())
+
+
+def is_pdb_path(content: str) -> bool:
+    """Whether a PDB given as content or path is a path to an existing file"""
+    # PDB content always spans multiple lines, so only single-line values
+    # can be paths (avoids stat'ing a multi-MB string)
+    return "\n" not in content and os.path.exists(content)
+
+
+def _is_cached_pdb(path: str) -> bool:
+    return os.path.dirname(os.path.abspath(path)) == PDB_CACHE_DIR
+
+
+def pdb_digest(content: str) -> str:
+    """SHA256 of a PDB given as content or path"""
+    if is_pdb_path(content):
+        # Cached files are named by their digest
+        if _is_cached_pdb(content):
+            return os.path.splitext(os.path.basename(content))[0]
+        h = hashlib.sha256()
+        with open(content, "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                h.update(chunk)
+        return h.hexdigest()
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
 def save_pdb_content(content: str, filepath: str) -> str:
-    """Save PDB content to file, return path"""
-    # If content is a file path that exists, just return it
-    if os.path.exists(content):
+    """Save PDB content to file via the PDB cache, return path"""
+    if is_pdb_path(content):
+        # Link uploads into the job directory so they are kept with its outputs
+        if _is_cached_pdb(content):
+            return link_file(content, filepath)
         return content
     
-    # Otherwise treat as PDB content and save
-    with open(filepath, 'w') as f:
-        f.write(content)
-    return filepath
+    # Otherwise treat as PDB content, writing it only if it is not already cached
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    cache_path = os.path.join(PDB_CACHE_DIR, f"{digest}.pdb")
+    if not os.path.exists(cache_path):
+        os.makedirs(PDB_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=PDB_CACHE_DIR, suffix=".tmp", delete=False) as f:
+            f.write(content)
+        cache_path = _cache_pdb(f.name, digest)
+    return link_file(cache_path, filepath)
+
+
+def link_file(src: str, dst: str) -> str:
+    """Hardlink a file to dst, falling back to a copy across filesystems"""
+    # Replace any existing file, as shutil.copy would
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+    return dst
+
+
+def link_or_copy(src: str, dst_dir: str) -> str:
+    """Hardlink a file into a directory, falling back to a copy across filesystems"""
+    return link_file(src, os.path.join(dst_dir, os.path.basename(src)))
+
+
+def run_model_script(
+    name: str,
+    script: str,
+    args: list,
+    cwd: str,
+    manifest: str,
+    gpu_id: Optional[int] = None,
+    worker=None
+) -> list:
+    """
+    Run one of the model scripts, either in a persistent ModelWorker or as a
+    fresh subprocess, and return the output files it produced.
+    
+    Workers return the outputs directly; subprocesses list them in the
+    manifest file they write.
+    """
+    if worker is not None:
+        logger.info(f"Running {name} in worker: {' '.join(args)}")
+        try:
+            return worker.run(args, cwd)
+        except RuntimeError as e:
+            logger.error(f"{name} failed: {e}")
+            raise RuntimeError(f"{name} failed: {str(e)[-500:]}") from e
+    
+    cmd = ["python", os.path.join(RFANTIBODY_ROOT, "scripts", script), *args]
+    
+    logger.info(f"Running {name}: {' '.join(cmd)}")
+    
+    # stdout is unused; keep only the tail of stderr for error reports so
+    # memory stays bounded however much the model logs
+    proc = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        env=subprocess_env(gpu_id)
+    )
+    stderr_tail = deque(proc.stderr, maxlen=STDERR_TAIL_LINES)
+    proc.stderr.close()
+    
+    if proc.wait() != 0:
+        stderr = "".join(stderr_tail)
+        logger.error(f"{name} failed: {stderr}")
+        raise RuntimeError(f"{name} failed: {stderr[-500:]}")
+    
+    with open(manifest) as f:
+        return json.load(f)["outputs"]
 
 
 def run_rfdiffusion(
@@ -54,7 +219,9 @@ def run_rfdiffusion(
     num_designs: int,
     diffusion_steps: int,
     output_dir: str,
-    progress_callback: Optional[Callable] = None
+    progress_callback: Optional[Callable] = None,
+    gpu_id: Optional[int] = None,
+    worker=None
 ) -> list:
     """Run RFdiffusion to generate antibody structures"""
     
@@ -67,9 +234,7 @@ def run_rfdiffusion(
     hotspots_str = "[" + ",".join(hotspot_residues) + "]"
     loops_str = "[" + ",".join(design_loops) + "]"
     
-    cmd = [
-        "python",
-        os.path.join(RFANTIBODY_ROOT, "scripts", "rfdiffusion_inference.py"),
+    args = [
         "--config-name", "antibody",
         f"antibody.target_pdb={target_pdb}",
         f"antibody.framework_pdb={framework_pdb}",
@@ -83,32 +248,105 @@ def run_rfdiffusion(
         f"inference.output_prefix={output_prefix}"
     ]
     
-    logger.info(f"Running RFdiffusion: {' '.join(cmd)}")
-    
-    result = subprocess.run(
-        cmd,
+    output_files = run_model_script(
+        "RFdiffusion",
+        "rfdiffusion_inference.py",
+        args,
         cwd=RFANTIBODY_ROOT,
-        capture_output=True,
-        text=True,
-        env={**os.environ, "PYTHONPATH": f"{os.path.join(RFANTIBODY_ROOT, 'src')}:{os.path.join(RFANTIBODY_ROOT, 'include', 'SE3Transformer')}"}
+        manifest=f"{output_prefix}.manifest.json",
+        gpu_id=gpu_id,
+        worker=worker
     )
     
-    if result.returncode != 0:
-        logger.error(f"RFdiffusion failed: {result.stderr}")
-        raise RuntimeError(f"RFdiffusion failed: {result.stderr[-500:]}")
-    
-    # Find output files
-    output_files = glob.glob(f"{output_prefix}*.pdb")
     logger.info(f"RFdiffusion generated {len(output_files)} structures")
     
     return output_files
 
 
+def rfdiffusion_batch_key(config: dict) -> tuple:
+    """
+    Key of a job's RFdiffusion inputs. Designs are seeded by their index, so jobs
+    with equal keys get the same designs and can share one RFdiffusion run
+    """
+    return (
+        pdb_digest(config["target_pdb"]),
+        pdb_digest(config.get("framework_pdb") or DEFAULT_FRAMEWORK_PDB),
+        tuple(config["hotspot_residues"]),
+        tuple(config.get("design_loops") or DEFAULT_DESIGN_LOOPS),
+        config.get("diffusion_steps", 50)
+    )
+
+
+def run_batched_rfdiffusion(
+    jobs: list,
+    progress_callback: Optional[Callable] = None,
+    gpu_id: Optional[int] = None,
+    worker=None
+) -> dict:
+    """
+    Run RFdiffusion once for several jobs with the same rfdiffusion_batch_key,
+    and link each job's designs into its output directory
+    
+    Args:
+        jobs: (job_id, config) pairs, the first job's inputs are used for the run
+        
+    Returns:
+        dict mapping each job_id to its RFdiffusion outputs
+    """
+    job_id, config = jobs[0]
+    num_designs = {batch_job_id: batch_config.get("num_designs", 1) for batch_job_id, batch_config in jobs}
+    
+    batch_dir = os.path.join(BATCHES_DIR, job_id)
+    os.makedirs(batch_dir, exist_ok=True)
+    
+    # Leave the inputs in place, each job still saves its own copy when it runs
+    target_pdb = config["target_pdb"]
+    if not is_pdb_path(target_pdb):
+        target_pdb = save_pdb_content(target_pdb, os.path.join(batch_dir, "target.pdb"))
+    framework_pdb = config.get("framework_pdb") or DEFAULT_FRAMEWORK_PDB
+    if not is_pdb_path(framework_pdb):
+        framework_pdb = save_pdb_content(framework_pdb, os.path.join(batch_dir, "framework.pdb"))
+    
+    try:
+        designs = run_rfdiffusion(
+            job_id=job_id,
+            target_pdb=target_pdb,
+            framework_pdb=framework_pdb,
+            hotspot_residues=config["hotspot_residues"],
+            design_loops=config.get("design_loops") or DEFAULT_DESIGN_LOOPS,
+            num_designs=max(num_designs.values()),
+            diffusion_steps=config.get("diffusion_steps", 50),
+            output_dir=batch_dir,
+            progress_callback=progress_callback,
+            gpu_id=gpu_id,
+            worker=worker
+        )
+        
+        # Each job gets the designs a run of its own would have produced
+        outputs = {}
+        for batch_job_id, n in num_designs.items():
+            design_dir = os.path.join(ensure_output_dir(batch_job_id), "rfdiffusion")
+            outputs[batch_job_id] = []
+            for design in designs[:n]:
+                trb = os.path.splitext(design)[0] + ".trb"
+                if os.path.exists(trb):
+                    link_or_copy(trb, design_dir)
+                outputs[batch_job_id].append(link_or_copy(design, design_dir))
+        
+        logger.info(f"Batched RFdiffusion generated {len(designs)} structures for {len(jobs)} jobs")
+        
+        return outputs
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
 def run_proteinmpnn(
     job_id: str,
     input_pdbs: list,
     output_dir: str,
-    progress_callback: Optional[Callable] = None
+    progress_callback: Optional[Callable] = None,
+    gpu_id: Optional[int] = None,
+    worker=None
 ) -> list:
     """Run ProteinMPNN to design sequences"""
     
@@ -120,34 +358,27 @@ def run_proteinmpnn(
     mpnn_output_dir = os.path.join(output_dir, "proteinmpnn")
     os.makedirs(mpnn_input_dir, exist_ok=True)
     
-    # Copy input PDBs
+    # Link input PDBs rather than copying them
     for pdb in input_pdbs:
-        shutil.copy(pdb, mpnn_input_dir)
+        link_or_copy(pdb, mpnn_input_dir)
     
-    cmd = [
-        "python",
-        os.path.join(RFANTIBODY_ROOT, "scripts", "proteinmpnn_interface_design.py"),
+    args = [
         "-pdbdir", mpnn_input_dir,
         "-outpdbdir", mpnn_output_dir,
-        "-seqs_per_struct", "1"
+        "-seqs_per_struct", "1",
+        "-batch_size", str(MPNN_BATCH_SIZE)
     ]
     
-    logger.info(f"Running ProteinMPNN: {' '.join(cmd)}")
-    
-    result = subprocess.run(
-        cmd,
+    output_files = run_model_script(
+        "ProteinMPNN",
+        "proteinmpnn_interface_design.py",
+        args,
         cwd=RFANTIBODY_ROOT,
-        capture_output=True,
-        text=True,
-        env={**os.environ, "PYTHONPATH": f"{os.path.join(RFANTIBODY_ROOT, 'src')}:{os.path.join(RFANTIBODY_ROOT, 'include', 'SE3Transformer')}"}
+        manifest=os.path.join(mpnn_output_dir, "manifest.json"),
+        gpu_id=gpu_id,
+        worker=worker
     )
     
-    if result.returncode != 0:
-        logger.error(f"ProteinMPNN failed: {result.stderr}")
-        raise RuntimeError(f"ProteinMPNN failed: {result.stderr[-500:]}")
-    
-    # Find output files
-    output_files = glob.glob(os.path.join(mpnn_output_dir, "*.pdb"))
     logger.info(f"ProteinMPNN generated {len(output_files)} sequences")
     
     return output_files
@@ -157,7 +388,9 @@ def run_rf2(
     job_id: str,
     input_pdbs: list,
     output_dir: str,
-    progress_callback: Optional[Callable] = None
+    progress_callback: Optional[Callable] = None,
+    gpu_id: Optional[int] = None,
+    worker=None
 ) -> list:
     """Run RF2 for structure prediction/validation"""
     
@@ -169,36 +402,28 @@ def run_rf2(
     rf2_output_dir = os.path.join(output_dir, "rf2")
     os.makedirs(rf2_input_dir, exist_ok=True)
     
-    # Copy input PDBs
+    # Link input PDBs rather than copying them
     for pdb in input_pdbs:
-        shutil.copy(pdb, rf2_input_dir)
+        link_or_copy(pdb, rf2_input_dir)
     
     # RF2 needs to run from its config directory
     rf2_config_dir = os.path.join(RFANTIBODY_ROOT, "src", "rfantibody", "rf2")
     
-    cmd = [
-        "python",
-        os.path.join(RFANTIBODY_ROOT, "scripts", "rf2_predict.py"),
+    args = [
         f"input.pdb_dir={rf2_input_dir}",
         f"output.pdb_dir={rf2_output_dir}"
     ]
     
-    logger.info(f"Running RF2: {' '.join(cmd)}")
-    
-    result = subprocess.run(
-        cmd,
+    output_files = run_model_script(
+        "RF2",
+        "rf2_predict.py",
+        args,
         cwd=rf2_config_dir,
-        capture_output=True,
-        text=True,
-        env={**os.environ, "PYTHONPATH": f"{os.path.join(RFANTIBODY_ROOT, 'src')}:{os.path.join(RFANTIBODY_ROOT, 'include', 'SE3Transformer')}"}
+        manifest=os.path.join(rf2_output_dir, "manifest.json"),
+        gpu_id=gpu_id,
+        worker=worker
     )
     
-    if result.returncode != 0:
-        logger.error(f"RF2 failed: {result.stderr}")
-        raise RuntimeError(f"RF2 failed: {result.stderr[-500:]}")
-    
-    # Find output files
-    output_files = glob.glob(os.path.join(rf2_output_dir, "*.pdb"))
     logger.info(f"RF2 generated {len(output_files)} predictions")
     
     return output_files
@@ -207,7 +432,10 @@ def run_rf2(
 def run_antibody_pipeline(
     job_id: str,
     config: dict,
-    progress_callback: Optional[Callable] = None
+    progress_callback: Optional[Callable] = None,
+    gpu_id: Optional[int] = None,
+    workers: Optional[dict] = None,
+    rfdiffusion_outputs: Optional[list] = None
 ) -> dict:
     """
     Run the full antibody design pipeline
@@ -223,6 +451,11 @@ def run_antibody_pipeline(
             - diffusion_steps: Number of diffusion steps
             - run_full_pipeline: Whether to run full pipeline
         progress_callback: Optional callback for progress updates
+        gpu_id: Optional GPU index to pin model subprocesses to
+        workers: Optional ModelWorkers keyed by stage name; stages without
+            a worker run as subprocesses
+        rfdiffusion_outputs: Designs already generated for this job by
+            run_batched_rfdiffusion; RFdiffusion is skipped when given
         
     Returns:
         dict with output file paths
@@ -250,25 +483,35 @@ def run_antibody_pipeline(
     else:
         framework_pdb = DEFAULT_FRAMEWORK_PDB
     
+    # The job keeps its config for its lifetime, so hold paths rather than
+    # possibly multi-MB PDB contents
+    config["target_pdb"] = target_pdb
+    if config.get("framework_pdb"):
+        config["framework_pdb"] = framework_pdb
+    
     # Get design parameters
     hotspot_residues = config["hotspot_residues"]
     design_loops = config.get("design_loops") or DEFAULT_DESIGN_LOOPS
     num_designs = config.get("num_designs", 1)
     diffusion_steps = config.get("diffusion_steps", 50)
     run_full_pipeline = config.get("run_full_pipeline", True)
+    workers = workers or {}
     
     # Step 1: RFdiffusion
-    rfdiffusion_outputs = run_rfdiffusion(
-        job_id=job_id,
-        target_pdb=target_pdb,
-        framework_pdb=framework_pdb,
-        hotspot_residues=hotspot_residues,
-        design_loops=design_loops,
-        num_designs=num_designs,
-        diffusion_steps=diffusion_steps,
-        output_dir=output_dir,
-        progress_callback=progress_callback
-    )
+    if rfdiffusion_outputs is None:
+        rfdiffusion_outputs = run_rfdiffusion(
+            job_id=job_id,
+            target_pdb=target_pdb,
+            framework_pdb=framework_pdb,
+            hotspot_residues=hotspot_residues,
+            design_loops=design_loops,
+            num_designs=num_designs,
+            diffusion_steps=diffusion_steps,
+            output_dir=output_dir,
+            progress_callback=progress_callback,
+            gpu_id=gpu_id,
+            worker=workers.get("rfdiffusion")
+        )
     
     proteinmpnn_outputs = []
     rf2_outputs = []
@@ -279,7 +522,9 @@ def run_antibody_pipeline(
             job_id=job_id,
             input_pdbs=rfdiffusion_outputs,
             output_dir=output_dir,
-            progress_callback=progress_callback
+            progress_callback=progress_callback,
+            gpu_id=gpu_id,
+            worker=workers.get("proteinmpnn")
         )
         
         # Step 3: RF2
@@ -288,7 +533,9 @@ def run_antibody_pipeline(
                 job_id=job_id,
                 input_pdbs=proteinmpnn_outputs,
                 output_dir=output_dir,
-                progress_callback=progress_callback
+                progress_callback=progress_callback,
+                gpu_id=gpu_id,
+                worker=workers.get("rf2")
             )
     
     if progress_callback:
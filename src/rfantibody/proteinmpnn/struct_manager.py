@@ -45,6 +45,9 @@ class StructManager():
 
         assert self.pdb ^ self.quiver, 'Either pdb or quiver must be set to True'
 
+        # PDB files written by dump_pose, in order
+        self.outputs = []
+
         # Setup checkpointing
         self.chkfn = args.checkpoint_name
         self.finished_structs = set()
@@ -92,6 +95,7 @@ class StructManager():
 
             pdbfile = os.path.join(self.outpdbdir, tag + '.pdb')
             pose.dump_pdb(pdbfile)
+            self.outputs.append(pdbfile)
         
         if self.quiver:
             pdblines = pose.to_pdblines()
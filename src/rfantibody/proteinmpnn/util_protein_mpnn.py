@@ -252,12 +252,20 @@ def set_default_args( seq_per_target, omit_AAs=['X'] ):
     return retval
 
 def generate_sequences( model, device, feature_dict, arg_dict, masked_chains, visible_chains, fixed_positions_dict=None ):
-    seqs_scores = []
+    chain_id_dict = { feature_dict['name'] : ( masked_chains, visible_chains ) } # Masked, visible is the order, I think - Nate
+
+    return generate_sequences_batch( model, device, [feature_dict], arg_dict, chain_id_dict, fixed_positions_dict=fixed_positions_dict )[0]
+
+def generate_sequences_batch( model, device, feature_dicts, arg_dict, chain_id_dict, fixed_positions_dict=None ):
+    '''
+    Design several structures in one padded batch. chain_id_dict and fixed_positions_dict are keyed by
+    feature_dict['name']. Returns a list of (seq, score) pairs for each feature dict, in order
+    '''
+    seqs_scores = [[] for _ in feature_dicts]
 
     with torch.no_grad():
 
-        batch_clones = [copy.deepcopy( feature_dict ) for i in range(arg_dict['BATCH_COPIES'])]
-        chain_id_dict = { feature_dict['name'] : ( masked_chains, visible_chains ) } # Masked, visible is the order, I think - Nate
+        batch_clones = [copy.deepcopy( feature_dict ) for feature_dict in feature_dicts for i in range(arg_dict['BATCH_COPIES'])]
 
         X, S, mask, lengths, chain_M, chain_encoding_all, chain_list_list, visible_list_list, masked_list_list, masked_chain_length_list_list, chain_M_pos, omit_AA_mask, residue_idx, dihedral_mask, tied_pos_list_of_lists_list, pssm_coef, pssm_bias, pssm_log_odds_all, bias_by_res_all, tied_beta= tied_featurize(
                 batch_clones, 
@@ -312,10 +320,10 @@ def generate_sequences( model, device, feature_dict, arg_dict, masked_chains, vi
             scores = _scores(S_sample, log_probs, mask_for_loss)
             scores = scores.cpu().data.numpy()
 
-            for b_ix in range(arg_dict['BATCH_COPIES']):
+            for b_ix in range(len(batch_clones)):
                 seq = _S_to_seq(S_sample[b_ix], chain_M[b_ix])
                 score = scores[b_ix]
 
-                seqs_scores.append((seq,score))
+                seqs_scores[b_ix // arg_dict['BATCH_COPIES']].append((seq,score))
 
     return seqs_scores
@@ -27,9 +27,18 @@ class AbPredictor(Predictor):
         self.return_rmsds=any([var is not None for var in [conf.input.pdb, conf.input.pdb_dir, conf.input.quiver]])
         self.xyz_converter.to(self.device)
 
-    def __call__(self, pose: Pose, tag: str) -> None:
+    def update_conf(self, conf: HydraConfig, preprocess_fn: Preprocess) -> None:
+        """
+        Switch to a new config while keeping the loaded model weights
+        """
+        self.conf=conf
+        self.preprocess_fn=preprocess_fn
+        self.return_rmsds=any([var is not None for var in [conf.input.pdb, conf.input.pdb_dir, conf.input.quiver]])
+
+    def __call__(self, pose: Pose, tag: str) -> list:
         """
         Runs prediction on a yielded pose
+        Returns the paths of any pdb files written
         """
         (    
                 network_input,
@@ -81,7 +90,7 @@ class AbPredictor(Predictor):
                 if self.conf.output.output_intermediates:
                     to_write[i_cycle] = {'pose': output_pose_i, 'metrics': metrics_i}
                 torch.cuda.empty_cache()
-        write_output(to_write, tag, self.conf)
+        return write_output(to_write, tag, self.conf)
 
     def _update_params_from_checkpoint(self) -> None:
         """
@@ -179,13 +188,15 @@ def get_rmsds(pose1: Pose, pose2: Pose, metrics: dict) -> None:
     for loop in pose1.cdrs.cdr_names():
         metrics[f'framework_aligned_{loop}_rmsd'] = rmsd.calc_prealigned_rmsd(pose1, pose2, getattr(pose1.cdrs, f'{loop}'))
     
-def write_output(to_write: OrderedDict, tag: str, conf: HydraConfig) -> None:
+def write_output(to_write: OrderedDict, tag: str, conf: HydraConfig) -> list:
     """
     Writes output to file. Either pdb or quiver file
+    Returns the paths of any pdb files written
     """
     if sum([var is not None for var in [conf.output.pdb_dir, conf.output.quiver]]) != 1:
         raise ValueError('Exactly one of output.pdb_dir or output.quiver must be specified')
     qv=conf.output.quiver is not None
+    written=[]
     for key, val in to_write.items():
         if key == 'best':
             suffix = 'best'
@@ -199,4 +210,7 @@ def write_output(to_write: OrderedDict, tag: str, conf: HydraConfig) -> None:
             pdblines=[f'QV_{line}' if line.startswith('SCORE') else line for line in pdblines]
             output_quiver.add_pdb(pdblines, tag=f'{tag}_{suffix}')
         else:
-            pu.pdblines_to_pdb(pdblines, f'{conf.output.pdb_dir}/{tag}_{suffix}.pdb')
+            pdb_path=f'{conf.output.pdb_dir}/{tag}_{suffix}.pdb'
+            pu.pdblines_to_pdb(pdblines, pdb_path)
+            written.append(pdb_path)
+    return written
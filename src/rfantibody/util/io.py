@@ -1,3 +1,5 @@
+import json
+
 import torch
 
 import numpy as np
@@ -34,6 +36,15 @@ def stamp_pdbline(
     )
 
 
+def write_manifest(path: str, outputs: List[str]) -> None:
+    """
+    Write a JSON manifest of the output files a run produced, so that
+    callers can find them without globbing the output directory
+    """
+    with open(path, 'w') as f:
+        json.dump({'outputs': outputs}, f)
+
+
 def ab_write_pdblines(
     atoms: np.ndarray,
     seq: np.ndarray,
@@ -0,0 +1,190 @@
+"""
+Unit tests for the API job manager
+"""
+import asyncio
+import io
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from rfantibody.api import pipeline
+from rfantibody.api.job_manager import JobManager
+from rfantibody.api.models import JobStatus
+
+
+def make_manager(monkeypatch, *configs):
+    """A JobManager that is not started, with one queued job per config"""
+    # Jobs with equal "key" share RFdiffusion inputs
+    monkeypatch.setattr(pipeline, "rfdiffusion_batch_key", lambda config: config["key"])
+    manager = JobManager(max_concurrent_jobs=1)
+    jobs = [manager.create_job(config) for config in configs]
+    return manager, jobs
+
+
+def pop_next(manager):
+    """Pop the next job the way an executor does, returning it and its batch candidates"""
+    job_id = manager._job_queue.popleft()
+    return manager.get_job(job_id), list(manager._job_queue)
+
+
+def test_claim_takes_matching_queued_jobs(monkeypatch):
+    manager, (a, b, c, d) = make_manager(
+        monkeypatch,
+        {"key": 1, "num_designs": 1},
+        {"key": 1, "num_designs": 2},
+        {"key": 1, "num_designs": 3},
+        {"key": 2, "num_designs": 1},
+    )
+    job, candidates = pop_next(manager)
+
+    # Another executor takes b between peeking at the queue and claiming
+    manager._job_queue.remove(b.job_id)
+
+    batch = manager._claim_rfdiffusion_batch(job, candidates)
+
+    assert job is a
+    assert batch == [c]
+    assert list(manager._job_queue) == [d.job_id]
+
+
+def test_claim_skips_jobs_with_designs(monkeypatch):
+    manager, (a, b) = make_manager(monkeypatch, {"key": 1}, {"key": 1})
+    b._shared_designs = ["design.pdb"]
+    job, candidates = pop_next(manager)
+
+    assert manager._claim_rfdiffusion_batch(job, candidates) == []
+    assert list(manager._job_queue) == [b.job_id]
+
+
+def test_batched_jobs_are_requeued_in_order_with_designs(monkeypatch):
+    manager, (a, b, c, d) = make_manager(
+        monkeypatch,
+        {"key": 1, "num_designs": 1},
+        {"key": 1, "num_designs": 2},
+        {"key": 1, "num_designs": 3},
+        {"key": 2, "num_designs": 1},
+    )
+
+    def run_batched_rfdiffusion(jobs, progress_callback=None, gpu_id=None, worker=None):
+        return {job_id: [f"{job_id}_{i}.pdb" for i in range(config["num_designs"])] for job_id, config in jobs}
+    monkeypatch.setattr(pipeline, "run_batched_rfdiffusion", run_batched_rfdiffusion)
+
+    calls = []
+    def pipeline_fn(job_id, config, rfdiffusion_outputs=None, **kwargs):
+        calls.append((job_id, rfdiffusion_outputs))
+        return {"rfdiffusion_outputs": rfdiffusion_outputs}
+
+    job, candidates = pop_next(manager)
+    batch = manager._claim_rfdiffusion_batch(job, candidates)
+    manager._execute_job(job, pipeline_fn, batch=batch)
+
+    assert list(manager._job_queue) == [b.job_id, c.job_id, d.job_id]
+    assert calls == [(a.job_id, [f"{a.job_id}_0.pdb"])]
+    assert a.status == JobStatus.COMPLETED
+    assert b.status == c.status == JobStatus.PENDING
+    assert b._shared_designs == [f"{b.job_id}_0.pdb", f"{b.job_id}_1.pdb"]
+
+    # Requeued jobs run with their designs and are not batched again
+    job, candidates = pop_next(manager)
+    assert job is b
+    assert manager._claim_rfdiffusion_batch(job, candidates) == []
+
+
+def test_failed_batch_falls_back_to_separate_runs(monkeypatch):
+    manager, (a, b, c) = make_manager(monkeypatch, {"key": 1}, {"key": 1}, {"key": 1})
+
+    def run_batched_rfdiffusion(jobs, **kwargs):
+        raise RuntimeError("RFdiffusion failed")
+    monkeypatch.setattr(pipeline, "run_batched_rfdiffusion", run_batched_rfdiffusion)
+
+    calls = []
+    def pipeline_fn(job_id, config, rfdiffusion_outputs=None, **kwargs):
+        calls.append((job_id, rfdiffusion_outputs))
+        return {}
+
+    job, candidates = pop_next(manager)
+    batch = manager._claim_rfdiffusion_batch(job, candidates)
+    assert batch == [b, c]
+    manager._execute_job(job, pipeline_fn, batch=batch)
+
+    # The leader runs RFdiffusion itself, the others are requeued unbatched
+    assert calls == [(a.job_id, None)]
+    assert list(manager._job_queue) == [b.job_id, c.job_id]
+    assert b._shared_designs is None and c._shared_designs is None
+
+    job, candidates = pop_next(manager)
+    assert job is b
+    assert manager._claim_rfdiffusion_batch(job, candidates) == []
+    assert list(manager._job_queue) == [c.job_id]
+
+
+def test_batch_key_matches_cached_and_inline_pdbs(monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, "PDB_CACHE_DIR", str(tmp_path / "pdb_cache"))
+    content = "ATOM      1  N   GLY T   1       0.000   0.000   0.000\nEND\n"
+    cached = pipeline.save_pdb_upload(io.BytesIO(content.encode()))
+
+    inline_config = {"target_pdb": content, "hotspot_residues": ["T1"]}
+    cached_config = {"target_pdb": cached, "hotspot_residues": ["T1"]}
+
+    assert pipeline.rfdiffusion_batch_key(cached_config) == pipeline.rfdiffusion_batch_key(inline_config)
+    assert pipeline.rfdiffusion_batch_key(inline_config) != pipeline.rfdiffusion_batch_key(
+        {**inline_config, "hotspot_residues": ["T2"]}
+    )
+
+
+def test_batched_rfdiffusion_gives_each_job_its_first_designs(monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, "JOBS_OUTPUT_DIR", str(tmp_path))
+    monkeypatch.setattr(pipeline, "BATCHES_DIR", str(tmp_path / "batches"))
+
+    def run_rfdiffusion(output_dir, num_designs, **kwargs):
+        designs = []
+        for i in range(num_designs):
+            design = tmp_path / "batches" / "a" / "rfdiffusion" / f"ab_des_{i}.pdb"
+            design.parent.mkdir(parents=True, exist_ok=True)
+            design.write_text(str(i))
+            designs.append(str(design))
+        return designs
+    monkeypatch.setattr(pipeline, "run_rfdiffusion", run_rfdiffusion)
+
+    config = {"target_pdb": "ATOM\nEND\n", "hotspot_residues": ["T1"]}
+    outputs = pipeline.run_batched_rfdiffusion([
+        ("a", {**config, "num_designs": 1}),
+        ("b", {**config, "num_designs": 3}),
+    ])
+
+    assert [open(path).read() for path in outputs["a"]] == ["0"]
+    assert [open(path).read() for path in outputs["b"]] == ["0", "1", "2"]
+    assert all(path.startswith(str(tmp_path / "b")) for path in outputs["b"])
+    assert not (tmp_path / "batches" / "a").exists()
+
+
+def test_progress_logs_each_stage_once(monkeypatch, caplog):
+    manager, (a,) = make_manager(monkeypatch, {"key": 1})
+    version = a.version
+
+    with caplog.at_level("INFO", logger="rfantibody.api.job_manager"):
+        for message in ["Preparing input files...", "Running RFdiffusion...", "Running RFdiffusion...", "Running ProteinMPNN..."]:
+            manager._update_progress(a.job_id, message)
+
+    assert [r.getMessage() for r in caplog.records] == [
+        f"Job {a.job_id}: Preparing input files...",
+        f"Job {a.job_id}: Running RFdiffusion...",
+        f"Job {a.job_id}: Running ProteinMPNN...",
+    ]
+    assert a.version == version + 3
+    assert a.status_dict()["progress"] == "Running ProteinMPNN..."
+
+
+def test_closed_long_poll_loop_does_not_fail_job(monkeypatch):
+    manager, (a,) = make_manager(monkeypatch, {"key": 1})
+
+    # A long-poll whose event loop has since shut down
+    loop = asyncio.new_event_loop()
+    a._waiters.append((loop, loop.create_future()))
+    loop.close()
+
+    manager._execute_job(a, lambda **kwargs: {})
+
+    assert a.status == JobStatus.COMPLETED
+    assert a.error is None
@@ -0,0 +1,64 @@
+"""
+Unit tests for the job status endpoint
+"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi.testclient import TestClient
+
+from rfantibody.api import main
+from rfantibody.api.job_manager import JobManager
+from rfantibody.api.models import JobStatus
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    # Not started, so jobs stay as the test leaves them
+    manager = JobManager(max_concurrent_jobs=1)
+    monkeypatch.setattr(main, "job_manager", manager)
+    return manager
+
+
+def get_status(job, wait, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    t0 = time.monotonic()
+    response = TestClient(main.app).get(f"/jobs/{job.job_id}", params={"wait": wait}, headers=headers)
+    return response, time.monotonic() - t0
+
+
+def test_wait_without_etag_returns_immediately(manager):
+    job = manager.create_job({})
+
+    response, seconds = get_status(job, wait=5)
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "pending"
+    assert seconds < 1
+
+
+def test_wait_on_finished_job_returns_immediately(manager):
+    job = manager.create_job({})
+    job._mutate(status=JobStatus.COMPLETED)
+    etag = get_status(job, wait=0)[0].headers["ETag"]
+
+    response, seconds = get_status(job, wait=5, etag=etag)
+
+    assert response.status_code == 304
+    assert seconds < 1
+
+
+def test_wait_with_current_etag_returns_on_change(manager):
+    job = manager.create_job({})
+    etag = get_status(job, wait=0)[0].headers["ETag"]
+    threading.Timer(0.2, job._mutate, kwargs={"progress": "Running RFdiffusion..."}).start()
+
+    response, seconds = get_status(job, wait=5, etag=etag)
+
+    assert response.status_code == 200
+    assert response.json()["progress"] == "Running RFdiffusion..."
+    assert response.headers["ETag"] != etag
+    assert seconds < 1
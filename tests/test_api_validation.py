@@ -0,0 +1,75 @@
+"""
+Unit tests for API request validation
+"""
+import io
+import os
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from rfantibody.api import main, pipeline
+from rfantibody.api.main import _validate_design_inputs
+
+
+@pytest.mark.parametrize("loops", [
+    None,
+    ["L1:8-13", "L2:7", "L3:9-11", "H1:7", "H2:6", "H3:5-13"],
+    ["H1:"],
+    ["H3:5-7|9|11-13"],
+])
+def test_valid_design_inputs(loops):
+    _validate_design_inputs(["T305", "T456"], loops)
+
+
+@pytest.mark.parametrize("hotspots", [["305"], ["t305"], ["T305A"], ["T"], ["T305\n"]])
+def test_invalid_hotspots(hotspots):
+    with pytest.raises(HTTPException) as e:
+        _validate_design_inputs(hotspots, None)
+    assert e.value.status_code == 422
+
+
+@pytest.mark.parametrize("loops", [["H4:5"], ["K1:5"], ["H3"], ["H3:5-"], ["H3:5||7"], ["H3:a"], ["h3:5-13"], ["H3:5-13\n"]])
+def test_invalid_design_loops(loops):
+    with pytest.raises(HTTPException) as e:
+        _validate_design_inputs(["T305"], loops)
+    assert e.value.status_code == 422
+
+
+def test_design_rejects_trailing_newline_in_hotspots():
+    response = TestClient(main.app).post(
+        "/design",
+        json={"target_pdb": "ATOM\nEND\n", "hotspot_residues": ["T305\n"]},
+    )
+    assert response.status_code == 422
+
+
+def test_upload_over_limit_is_not_kept(monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, "PDB_CACHE_DIR", str(tmp_path))
+
+    with pytest.raises(ValueError):
+        pipeline.save_pdb_upload(io.BytesIO(b"x" * 10), max_bytes=9)
+    assert os.listdir(tmp_path) == []
+
+    path = pipeline.save_pdb_upload(io.BytesIO(b"x" * 9), max_bytes=9)
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+
+def test_oversized_framework_saves_neither_upload(monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, "PDB_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "MAX_PDB_BYTES", 16)
+
+    response = TestClient(main.app).post(
+        "/design/upload",
+        data={"hotspot_residues": "T305"},
+        files={
+            "target_pdb": ("target.pdb", b"ATOM\nEND\n"),
+            "framework_pdb": ("framework.pdb", b"ATOM\n" * 10),
+        },
+    )
+
+    assert response.status_code == 413
+    assert os.listdir(tmp_path) == []